@@ -6,5 +6,5 @@ __version__ = '0.1'
 
 # Import all the functions that make up the public API.
 # noinspection PyUnresolvedReferences
-from ebird.pages.checklists import get_checklist
+from ebird.pages.checklists import clear_cache, get_checklist, get_checklists
 
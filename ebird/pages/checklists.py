@@ -1,8 +1,60 @@
+import copy
 import datetime
-import re
+import functools
 import requests
 
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lxml import etree, html
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# All downloads share one session so the connections to ebird.org are kept
+# alive and reused instead of being opened again for every checklist. Failed
+# connections and responses showing the server is busy are retried, with
+# a back-off, so one dropped request does not abort a batch of downloads.
+# When the retries run out the last response is returned, rather than
+# raising RetryError, so raise_for_status() still reports an HTTPError.
+_RETRIES = Retry(
+    total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+    raise_on_status=False)
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16, pool_maxsize=32, max_retries=_RETRIES))
+
+_TIMEOUT = 30
+
+
+# The XPath expressions are compiled once here rather than each time
+# a page is scraped.
+_IDENTIFIER_XPATH = etree.XPath('.//input[@name="subID"]/@value')
+_HOTSPOT_XPATH = etree.XPath('.//a[contains(@href, "hotspot")]')
+_REGIONS_XPATH = etree.XPath(
+    '(.//a[contains(@href, "region")])[position() <= 3]'
+)
+_COORDS_XPATH = etree.XPath(
+    './/a[contains(@class, "u-inset-squish-sm")]/@href'
+)
+_PROTOCOL_NAME_XPATH = etree.XPath(
+    './/span[@class="Heading-main u-inline-sm"]'
+)
+_DATETIME_XPATH = etree.XPath('.//time/@datetime')
+_BADGES_XPATH = etree.XPath(
+    './/span[@title][.//span[contains(@class, "Badge-label")]]'
+)
+_BADGE_LABEL_XPATH = etree.XPath('.//span[contains(@class, "Badge-label")]')
+_AREA_XPATH = etree.XPath(
+    './/dt[starts-with(normalize-space(), "Area")]/..//dd'
+)
+_OWNER_XPATH = etree.XPath('.//span[text()="Owner"]')
+_OTHERS_XPATH = etree.XPath('.//div[@id="checklist-others"]')
+_COMMENT_XPATH = etree.XPath('.//p[contains(@class, "u-constrainBody")]')
+_ENTRIES_XPATH = etree.XPath('.//div[@id="list"]//li[@data-observation]')
+# Find the species name and the count for an entry in a single query. The
+# union returns the nodes in document order: species first then count.
+_ENTRY_XPATH = etree.XPath(
+    '(.//div[contains(@class, "Observation-species")]//span)[1]'
+    ' | (.//div[contains(@class, "Observation-numberObserved")]//span)[last()]'
+)
 
 
 def get_checklist(identifier):
@@ -15,6 +67,10 @@ def get_checklist(identifier):
     Returns:
         (dict): all the fields extracted from the web page.
 
+    The results are cached for the life of the process so asking for the
+    same checklist again does not download the page. Call clear_cache() to
+    fetch the latest version of a checklist which has been edited.
+
     ToDo:
         * scrape entry comments.
         * scrape age/sex table
@@ -23,328 +79,291 @@ def get_checklist(identifier):
         * update scraping of different protocols
 
     """
-    url = "https://ebird.org/checklist/" + identifier
-    response = requests.get(url)
-    response.raise_for_status()
-    return _scrape_checklist(response.text)
+    return copy.deepcopy(_fetch_checklist(identifier))
 
 
-def _scrape_checklist(contents):
-    soup = BeautifulSoup(contents, "lxml")
-    return {
-        "identifier": _scrape_identifier(soup),
-        "date": _scrape_date(soup),
-        "protocol": _scrape_protocol(soup),
-        "location": _scrape_location(soup),
-        "entries": _scrape_entries(soup),
-        "comment": _scrape_comment(soup),
-        "complete": _scrape_complete(soup),
-    }
+def get_checklists(identifiers, max_workers=16):
+    """
+    Get the data for several checklists, downloading the pages concurrently.
 
+    Args:
+        identifiers (iterable): the unique identifiers for the checklists.
+        max_workers (int): the maximum number of pages downloaded at once.
 
-def _scrape_identifier(node):
-    return node.find("input", {"name": "subID"})["value"]
+    Returns:
+        (generator): the dict of fields for each checklist, in the order
+            the downloads complete rather than the order of identifiers.
 
+    The results are cached in the same way as for get_checklist().
 
-def _scrape_location(node):
-    _node = node.find_all("section")[2]
-    coords = _scrape_coords(node).split(",")
-    return {
-        "name": _scrape_site(node),
-        "identifier": _scrape_location_identifier(node),
-        "subnational2": _scrape_subnational2(node),
-        "subnational2_code": _scrape_subnational2_code(node),
-        "subnational1": _scrape_subnational1(node),
-        "subnational1_code": _scrape_subnational1_code(node),
-        "country": _scrape_country(node),
-        "country_code": _scrape_country_code(node),
-        "lat": coords[0],
-        "lon": coords[1],
-    }
+    If a checklist cannot be downloaded or scraped the exception is raised
+    as soon as it is reached. The downloads which have not started yet are
+    cancelled and only the ones in progress are waited for. The same
+    happens if the caller stops iterating before all the checklists have
+    been returned.
 
-
-def _scrape_site(node):
-    return node.find("a", href=re.compile("hotspot")).span.text
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_fetch_checklist, identifier)
+            for identifier in identifiers
+        ]
+        try:
+            for future in as_completed(futures):
+                yield copy.deepcopy(future.result())
+        finally:
+            for future in futures:
+                future.cancel()
 
 
-def _scrape_subnational2(node):
-    return node.find("a", href=re.compile("region")).text
+def clear_cache():
+    """
+    Discard the cached results for all the checklists downloaded so far.
 
+    The next call to get_checklist() or get_checklists() for a checklist
+    will download the page again.
 
-def _scrape_subnational2_code(node):
-    return node.find("a", href=re.compile("region")).attrs["href"].split("/")[2]
+    """
+    _fetch_checklist.cache_clear()
 
 
-def _scrape_subnational1(node):
-    return node.find_all("a", href=re.compile("region"))[1].span.text
+# Submitted checklists rarely change so pages which have already been
+# scraped are not downloaded again. Callers get a copy of the cached
+# results so they are free to modify them.
+@functools.lru_cache(maxsize=4096)
+def _fetch_checklist(identifier):
+    url = "https://ebird.org/checklist/" + identifier
+    with _SESSION.get(url, stream=True, timeout=_TIMEOUT) as response:
+        response.raise_for_status()
+        # Feed the raw bytes to the parser as they arrive rather than
+        # buffering and decoding the whole page first.
+        response.raw.decode_content = True
+        parser = _parser(_charset(response))
+        tree = html.parse(response.raw, parser=parser).getroot()
+    return _scrape_tree(tree)
 
 
-def _scrape_subnational1_code(node):
-    return node.find_all("a", href=re.compile("region"))[1].attrs["href"].split("/")[2]
+def _scrape_checklist(contents):
+    return _scrape_tree(html.fromstring(contents, parser=_parser()))
 
 
-def _scrape_country(node):
-    return node.find_all("a", href=re.compile("region"))[2].span.text
+def _charset(response):
+    # Use the charset from the Content-Type header, if there is one, since
+    # it takes precedence over any <meta> charset in the page. When it is
+    # missing, requests sets response.encoding to ISO-8859-1 for all text
+    # types so it is ignored and lxml detects the encoding from the page.
+    content_type = response.headers.get("Content-Type", "")
+    return response.encoding if "charset" in content_type.lower() else None
 
 
-def _scrape_country_code(node):
-    return node.find_all("a", href=re.compile("region"))[2].attrs["href"].split("/")[2]
+def _parser(encoding=None):
+    # The pages are only queried with XPath so there is no need for lxml to
+    # build the index of element ids used by getElementById. A new parser is
+    # used each time so they are not shared between the download threads.
+    return html.HTMLParser(collect_ids=False, encoding=encoding)
 
 
-def _scrape_location_identifier(node):
-    return node.find("a", href=re.compile("hotspot")).attrs["href"].split("/")[2]
+def _scrape_tree(tree):
+    return {
+        "identifier": _scrape_identifier(tree),
+        "date": _scrape_date(tree),
+        "protocol": _scrape_protocol(tree),
+        "location": _scrape_location(tree),
+        "entries": _scrape_entries(tree),
+        "comment": _scrape_comment(tree),
+        "complete": _scrape_complete(tree),
+    }
 
 
-def _scrape_coords(node):
-    return node.find("a", {"class": "u-inset-squish-sm"}).attrs["href"].split("=")[2]
+def _scrape_identifier(node):
+    return _IDENTIFIER_XPATH(node)[0]
 
 
-def _point_protocol(node):
-    results = {
-        "time": _scrape_time(node),
-        "duration": _scrape_duration(node),
-        "party_size": _scrape_party_size(node),
-        "observers": _scrape_observers(node),
+def _scrape_location(node):
+    hotspot = _HOTSPOT_XPATH(node)[0]
+    regions = _REGIONS_XPATH(node)
+    coords = _scrape_coords(node).split(",")
+    return {
+        "name": hotspot.find(".//span").text_content(),
+        "identifier": _scrape_href_code(hotspot),
+        "subnational2": regions[0].text_content(),
+        "subnational2_code": _scrape_href_code(regions[0]),
+        "subnational1": regions[1].find(".//span").text_content(),
+        "subnational1_code": _scrape_href_code(regions[1]),
+        "country": regions[2].find(".//span").text_content(),
+        "country_code": _scrape_href_code(regions[2]),
+        "lat": coords[0],
+        "lon": coords[1],
     }
 
-    if not results["time"]:
-        raise ValueError("the time field was not found")
 
-    if not results["duration"]:
-        raise ValueError("the duration field was not found")
+def _scrape_href_code(node):
+    return node.get("href").split("/")[2]
 
-    if not results["party_size"]:
-        raise ValueError("the party size field was not found")
 
-    return results
+def _scrape_coords(node):
+    return _COORDS_XPATH(node)[0].split("=")[2]
 
 
-def _distance_protocol(node):
-    results = {
-        "time": _scrape_time(node),
-        "duration": _scrape_duration(node),
-        "distance": _scrape_distance(node),
-        "party_size": _scrape_party_size(node),
-        "observers": _scrape_observers(node),
-    }
+# The fields recorded for each protocol, split into the ones which must be
+# on the page and the ones which are included only if present. The observers
+# are always included.
+_protocols = {
+    "Stationary": (("time", "duration", "party_size"), ()),
+    "Traveling": (("time", "duration", "distance", "party_size"), ()),
+    "Incidental": ((), ("time",)),
+    "Historical": ((), ("time", "duration", "distance", "area", "party_size")),
+    "Area": (("time", "area", "duration", "party_size"), ()),
+    "Banding": (("time", "duration", "party_size"), ()),
+    "eBird Pelagic Protocol":
+        (("time", "duration", "distance", "party_size"), ()),
+    "Nocturnal Flight Call Count": (("time", "duration", "party_size"), ()),
+    "Random": (("time", "duration", "distance", "party_size"), ()),
+    "CWC Point Count": (("time", "duration", "party_size"), ()),
+    "CWC Area Count": (("time", "area", "duration", "party_size"), ()),
+    "PROALAS": (("time", "duration", "party_size"), ()),
+    "TNC California Waterbird Count": (("time", "duration", "party_size"), ()),
+    "Rusty BlackbirdSpring Migration Blitz":
+        (("time", "duration", "distance", "party_size"), ()),
+    "California Brown Pelican Survey":
+        (("time", "duration", "distance", "party_size"), ()),
+}
 
-    if not results["time"]:
-        raise ValueError("the time field was not found")
 
-    if results["duration"] is None:
-        raise ValueError("the duration field was not found")
+def _scrape_protocol(node):
+    results = {
+        "name": _scrape_protocol_name(node),
+    }
 
-    if results["distance"] == (None, None):
-        raise ValueError("the distance field was not found")
+    fields = _protocols.get(results["name"])
+    if fields is None:
+        raise ValueError("unknown protocol %r" % results["name"])
 
-    if not results["party_size"]:
-        raise ValueError("the party size field was not found")
+    required, optional = fields
+    results.update(_scrape_protocol_fields(node, required, optional))
 
     return results
 
 
-def _incidental_observations(node):
-    results = {
-        "observers": _scrape_observers(node),
-    }
-
-    time = _scrape_time(node)
-    if time:
-        results["time"] = time
+# The title of the badge which displays each of the protocol fields.
+_badges = {
+    "duration": "Duration",
+    "distance": "Distance",
+    "party_size": "Observers",
+}
 
-    return results
 
+def _scrape_protocol_fields(node, required, optional):
+    # Only the fields recorded by the protocol are scraped. For example there
+    # is no search for an area on Traveling checklists, the most common ones,
+    # and the badges are not read at all for Incidental checklists.
+    badges = None
 
-def _historical_observations(node):
     results = {
         "observers": _scrape_observers(node),
     }
 
-    time = _scrape_time(node)
-    if time:
-        results["time"] = time
-
-    duration = _scrape_duration(node)
-    if duration:
-        results["duration"] = duration
-
-    distance = _scrape_distance(node)
-    if distance != (None, None):
-        results["distance"] = distance
-
-    area = _scrape_area(node)
-    if area != (None, None):
-        results["area"] = area
-
-    party_size = _scrape_party_size(node)
-    if party_size:
-        results["party_size"] = party_size
-
-    return results
-
-
-def _area_protocol(include_area=True):
-    def _scrape_area_fields(node):
-        results = {
-            "time": _scrape_time(node),
-            "area": _scrape_area(node),
-            "duration": _scrape_duration(node),
-            "party_size": _scrape_party_size(node),
-            "observers": _scrape_observers(node),
-        }
-
-        if not results["time"]:
-            raise ValueError("the time field was not found")
-
-        if include_area:
-            if results["area"] == (None, None):
-                raise ValueError("the area field was not found")
+    for name in required + optional:
+        if name == "time":
+            value = _scrape_time(node)
+        elif name == "area":
+            value = _scrape_area(node)
+            if value == (None, None):
+                value = None
         else:
-            del results["area"]
-
-        if results["duration"] is None:
-            raise ValueError("the duration field was not found")
-
-        if not results["party_size"]:
-            raise ValueError("the party size field was not found")
-
-        return results
-
-    return _scrape_area_fields
+            if badges is None:
+                badges = _scrape_badges(node)
+            value = badges.get(_badges[name])
 
+        if value:
+            results[name] = value
+        elif name in required:
+            raise ValueError(
+                "the %s field was not found" % name.replace("_", " "))
 
-_protocols = {
-    "Stationary": _point_protocol,
-    "Traveling": _distance_protocol,
-    "Incidental": _incidental_observations,
-    "Historical": _historical_observations,
-    "Area": _area_protocol(),
-    "Banding": _area_protocol(include_area=False),
-    "eBird Pelagic Protocol": _distance_protocol,
-    "Nocturnal Flight Call Count": _point_protocol,
-    "Random": _distance_protocol,
-    "CWC Point Count": _point_protocol,
-    "CWC Area Count": _area_protocol(),
-    "PROALAS": _point_protocol,
-    "TNC California Waterbird Count": _point_protocol,
-    "Rusty BlackbirdSpring Migration Blitz": _distance_protocol,
-    "California Brown Pelican Survey": _distance_protocol,
-}
-
-
-def _scrape_protocol(node):
-    results = {
-        "name": _scrape_protocol_name(node),
-    }
+    return results
 
-    # TODO enable
-    results.update(_protocols[results["name"]](node))
 
-    return results
+def _scrape_badges(node):
+    # The duration, distance, party size, etc. are displayed as badges. The
+    # title of each one, e.g. "Duration: 3 hour(s)", identifies the field.
+    badges = {}
+    for tag in _BADGES_XPATH(node):
+        name = tag.get("title").split(":")[0].strip()
+        if name not in badges:
+            label = _BADGE_LABEL_XPATH(tag)[0]
+            badges[name] = label.text_content()
+    return badges
 
 
 def _scrape_protocol_name(node):
-    return node.find("span", {"class": "Heading-main u-inline-sm"}).text
+    return _PROTOCOL_NAME_XPATH(node)[0].text_content()
 
 
 def _scrape_date(node):
-    value = node.find("time")["datetime"]
-    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M")
+    value = _DATETIME_XPATH(node)[0]
+    return _parse_datetime(value)
 
 
 def _scrape_time(node):
     time = None
-    value = node.find("time").attrs["datetime"]
+    value = _DATETIME_XPATH(node)[0]
     if value:
-        dt = datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M")
+        dt = _parse_datetime(value)
         time = dt.strftime("%I:%M %p")
     return time
 
 
-def _scrape_party_size(node):
-    count = None
-    regex = re.compile(r"\s*[Oo]bservers[:]?\s*")
-    tag = node.find("span", string=regex)
-    count = tag.find_next_sibling().text
-    return count
-
-
-def _scrape_distance(node):
-    regex = re.compile(r"\s*[Dd]istance[:]?\s*")
-    dist = node.find("span", {"title": regex})
-
-    if dist:
-        dist = dist.find("span", {"class": "Badge-label"}).text
-
-    return dist
-
-
-_scrape_distance.units = {
-    "kilometer(s)": "km",
-    "kilometre(s)": "km",
-    "km(s)": "km",
-    "kilometers": "km",
-    "kilometres": "km",
-    "km": "km",
-    "kms": "km",
-    "mile(s)": "mi",
-    "miles": "mi",
-}
+def _parse_datetime(value):
+    # The datetime attribute always has the form YYYY-MM-DDTHH:MM so the
+    # fields are sliced out directly which is much faster than strptime.
+    return datetime.datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]))
 
 
 def _scrape_area(node):
     area = None
     units = None
 
-    regex = re.compile(r"\s*[Aa]rea[:]?\s*")
-    tag = node.find("dt", text=regex)
+    tags = _AREA_XPATH(node)
 
-    if tag:
-        field = tag.parent.dd
-        values = field.text.lower().split()
+    if tags:
+        values = tags[0].text_content().split()
         area = float(values[0])
-        units = _scrape_area.units[values[1]]
+        units = _normalize_units(values[1])
 
     return area, units
 
 
-_scrape_area.units = {
-    "hectare(s)": "ha",
-    "hectares": "ha",
-    "ha": "ha",
-    "acre(s)": "acre",
-    "acres": "acre",
-}
-
+def _normalize_units(value):
+    # Reduce the variations, e.g. "Hectare(s)", "hectares", "ha", to the
+    # singular form before looking up the abbreviation.
+    return _units[value.lower().replace("(s)", "").rstrip("s")]
 
-def _scrape_duration(node):
-    duration = None
 
-    regex = re.compile(r"\s*[Dd]uration[:]?\s*")
-    tag = node.find("span", {"title": regex})
-
-    if tag:
-        duration = tag.find("span", {"class": "Badge-label"}).text
-
-    return duration
+_units = {
+    "hectare": "ha",
+    "ha": "ha",
+    "acre": "acre",
+}
 
 
 def _scrape_observers(node):
     observers = []
-    owner = node.find("span", string="Owner")
-    observers.append(owner.text)
-    others = node.find("div", {"id": "checklist-others"})
-    for t in others:
-        try:
-            observers.append(t.find("span").text)
-        except:
-            pass
+    owner = _OWNER_XPATH(node)[0]
+    observers.append(owner.text_content())
+    for others in _OTHERS_XPATH(node):
+        for t in others.iterchildren(etree.Element):
+            span = t.find(".//span")
+            if span is not None:
+                observers.append(span.text_content())
     return observers
 
 
 def _scrape_comment(node):
     # TODO Comments visible only if logged in.
-    comment = node.find("p", {"class": "u-constrainBody"})
+    comment = _COMMENT_XPATH(node)
     # section = node.find("h6", text="Checklist Comments").parent
     # items = [p.text.strip() for p in section.find_all("p")]
     # return " ".join(items)
@@ -352,41 +371,38 @@ def _scrape_comment(node):
 
 def _scrape_entries(node):
     entries = []
-    node = node.find("div", {"id": "list"})
-    if node:
-        tags = node.find_all("li", {"data-observation": ""})
-        for tag in tags:
-            entries.append(_scrape_entry(tag))
+    for tag in _ENTRIES_XPATH(node):
+        entries.append(_scrape_entry(tag))
     return entries
 
 
 def _scrape_entry(node):
+    species, count = _ENTRY_XPATH(node)
     return {
-        "species": _scrape_species(node),
-        "count": _scrape_count(node),
+        "species": _scrape_species(species),
+        "count": _scrape_count(count),
     }
 
 
-def _scrape_species(node):
-    node = node.find("div", {"class": "Observation-species"}).span.text
-    # tag = node.find("span", {"class": "Heading-main"})
-    # value = " ".join(tag.text.split())
-    return node
+def _scrape_species(tag):
+    return tag.text_content()
 
 
-def _scrape_count(node):
+def _scrape_count(tag):
     count = None
-    node = node.find("div", class_="Observation-numberObserved")
-    tag = node.find_all("span")[-1]
-    value = tag.text.strip().lower()
-    if value != "x":
+    value = (tag.text or "").strip()
+    if value and value not in ("x", "X"):
         count = int(value)
     return count
 
 
 def _scrape_complete(node):
-    value = node.find_all("span", {"class": "Badge-label"})[0].text
-    return value == "Complete"
+    # Only the first badge is needed so stop at the first match instead of
+    # searching the rest of the page for other badges, as xpath would.
+    for tag in node.iter("span"):
+        if "Badge-label" in (tag.get("class") or "").split():
+            return tag.text_content() == "Complete"
+    return False
 
 
 if __name__ == "__main__":
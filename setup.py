@@ -49,7 +49,6 @@ setup(
         'Topic :: Internet',
     ],
     install_requires=[
-        'beautifulsoup4',
         'lxml',
         'requests',
     ],